@@ -1,13 +1,11 @@
-import asyncio
-
 import chainlit as cl
 import chainlit.data as cl_data
 from chainlit.input_widget import Select
 
 from lit_data_layers.sqldb import SqlDataLayer
 
+# Tables are created lazily on the first query, on Chainlit's own event loop
 layer = SqlDataLayer()
-asyncio.get_event_loop().run_until_complete(layer.initialize_database())
 cl_data._data_layer = layer
 
 
@@ -1,24 +1,141 @@
+import asyncio
+import base64
 import datetime
+import functools
+import inspect
+import itertools
+import json
 import os
 import uuid
+from collections import defaultdict, deque
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime, timezone
-from typing import Optional, Dict, List
+from typing import Any, Callable, Optional, Dict, List, NamedTuple
 
 from chainlit import PersistedUser, User, ThreadDict
-from chainlit.data import BaseDataLayer, queue_until_user_message
+from chainlit.context import context
+from chainlit.data import BaseDataLayer
 from chainlit.element import ElementDict
+from chainlit.logger import logger
+from chainlit.session import WebsocketSession
 from chainlit.step import StepDict
 from chainlit.types import Feedback, Pagination, ThreadFilter
 from literalai import PageInfo
 from literalai import PaginatedResponse
-from sqlalchemy import update
+from sqlalchemy import delete, insert, update, make_url, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import sessionmaker, selectinload
+from sqlalchemy.orm import raiseload, sessionmaker
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from .cache import TTLCache
 from .models import Base, PersistedUserModel, ElementModel, ThreadModel, StepModel, Feedback as FeedbackModel
 
+# Columns selected by the read paths, so that rows can be serialized without building ORM objects
+USER_COLUMNS = (
+    PersistedUserModel.id,
+    PersistedUserModel.identifier,
+    PersistedUserModel.createdAt,
+    PersistedUserModel.metadata_,
+)
+THREAD_COLUMNS = (
+    ThreadModel.id,
+    ThreadModel.name,
+    ThreadModel.createdAt,
+    ThreadModel.metadata_,
+    ThreadModel.tags,
+    PersistedUserModel.id.label("user_id"),
+    PersistedUserModel.identifier.label("user_identifier"),
+    PersistedUserModel.createdAt.label("user_createdAt"),
+    PersistedUserModel.metadata_.label("user_metadata"),
+)
+STEP_COLUMNS = (
+    StepModel.id,
+    StepModel.thread_id,
+    StepModel.parent_id,
+    StepModel.name,
+    StepModel.type,
+    StepModel.input,
+    StepModel.output,
+    StepModel.metadata_,
+    StepModel.created_at,
+    StepModel.start_time,
+    StepModel.end_time,
+)
+ELEMENT_COLUMNS = (
+    ElementModel.id,
+    ElementModel.thread_id,
+    ElementModel.type,
+    ElementModel.chainlit_key,
+    ElementModel.url,
+    ElementModel.object_key,
+    ElementModel.name,
+    ElementModel.display,
+    ElementModel.size,
+    ElementModel.language,
+    ElementModel.mime,
+    ElementModel.for_id,
+    ElementModel.page,
+)
+
+class SharedTransaction(NamedTuple):
+    """
+    A transaction opened by ``SqlDataLayer.transaction()`` and shared by the calls made inside it.
+    """
+    layer: Any
+    task: Optional[asyncio.Task]
+    session: AsyncSession
+    # Run in order once the transaction commits
+    after_commit: List[Callable[[], Any]]
+
+
+# The SharedTransaction opened in the current context, if any
+current_transaction: ContextVar[Optional[SharedTransaction]] = ContextVar('lit_data_layers_transaction', default=None)
+
+
+def batch_until_user_message():
+    """
+    Like Chainlit's ``queue_until_user_message``, but rather than replaying each queued
+    call on its own, the calls are collected and handed to ``flush_queued_writes`` so
+    that they are written in a single transaction once the user sends a message.
+    As with Chainlit's queue, a failing call only loses its own write.
+    """
+
+    def decorator(method):
+        signature = inspect.signature(method)
+        parameter = list(signature.parameters)[1]
+
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            if (
+                isinstance(context.session, WebsocketSession)
+                and not context.session.has_first_interaction
+            ):
+                queue = context.session.thread_queues.setdefault('flush_queued_writes', deque())
+                if queue:
+                    # Chainlit queues (method, self, args, kwargs); the flush's only argument is
+                    # the list of operations collected so far
+                    _, _, (operations,), _ = queue[0]
+                else:
+                    operations = []
+                    queue.append((type(self).flush_queued_writes, self, (operations,), {}))
+                argument = signature.bind(self, *args, **kwargs).arguments[parameter]
+                operations.append((method.__name__, argument))
+            else:
+                return await method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
 
 class SqlDataLayer(BaseDataLayer):
     def __init__(self):
@@ -28,28 +145,178 @@ class SqlDataLayer(BaseDataLayer):
         if not self.database_url:
             raise EnvironmentError('LIT_DATABASE_URL is not defined in the environment.')
 
-        self.engine = create_async_engine(self.database_url, echo=is_debugging)
+        url = make_url(self.database_url)
+        if url.drivername in ('postgres', 'postgresql', 'postgresql+psycopg2'):
+            # Only asyncpg gives a fully asynchronous PostgreSQL driver with prepared statement caching
+            url = url.set(drivername='postgresql+asyncpg')
+
+        engine_options = {'echo': is_debugging, 'pool_pre_ping': True}
+        if orjson is not None:
+            engine_options.update(json_serializer=json_serialize, json_deserializer=orjson.loads)
+        if url.get_backend_name() == 'postgresql':
+            engine_options.update(pool_size=20, max_overflow=10, pool_recycle=1800)
+        if url.get_driver_name() == 'asyncpg':
+            statement_cache_size = int(os.environ.get('LIT_DATABASE_STATEMENT_CACHE_SIZE', default='1024'))
+            engine_options['connect_args'] = {
+                # JIT compilation only slows down the short OLTP queries issued here
+                'server_settings': {'jit': 'off'},
+                'statement_cache_size': statement_cache_size,
+                'prepared_statement_cache_size': statement_cache_size,
+            }
+        for option in ('pool_size', 'max_overflow'):
+            value = os.environ.get(f'LIT_DATABASE_{option.upper()}')
+            if value:
+                engine_options[option] = int(value)
+
+        self.pool_size = engine_options.get('pool_size', 0)
+        self.engine = create_async_engine(url, **engine_options)
         self.AsyncSession = sessionmaker(
             self.engine, expire_on_commit=False, class_=AsyncSession
         )
 
+        self._initialized = False
+        self._initialize_lock = asyncio.Lock()
+
+        cache_ttl = float(os.environ.get('LIT_DATABASE_CACHE_TTL', default='60'))
+        self.user_cache = TTLCache(maxsize=10_000, ttl=cache_ttl)
+        self.thread_author_cache = TTLCache(maxsize=10_000, ttl=cache_ttl)
+
     async def initialize_database(self):
         """
-        Asynchronously create database tables if they do not exist.
+        Asynchronously create database tables if they do not exist, then open the
+        pool's connections up front so the first requests don't pay for connecting.
+        This runs at most once, and is called automatically on first use.
         """
-        async with self.engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
+        async with self._initialize_lock:
+            if self._initialized:
+                return
+
+            async with self.engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.run_sync(create_unique_indexes)
+
+            if self.pool_size:
+                results = await asyncio.gather(
+                    *(self.engine.connect() for _ in range(self.pool_size)), return_exceptions=True
+                )
+                # Return every connection that did open to the pool before reporting a failure
+                await asyncio.gather(
+                    *(result.close() for result in results if not isinstance(result, BaseException))
+                )
+                errors = [result for result in results if isinstance(result, BaseException)]
+                if errors:
+                    raise errors[0]
+
+            self._initialized = True
 
     @asynccontextmanager
     async def async_context(self):
         """
         Provide an asynchronous context manager for database sessions.
-        This ensures that the session is properly closed after use.
+        The session runs inside a single transaction which is committed when the
+        block exits (or rolled back on error), and is closed afterwards.
         """
+        if not self._initialized:
+            await self.initialize_database()
+
+        transaction = self._current_transaction()
+        if transaction:
+            yield transaction.session
+            return
+
         async with self.AsyncSession() as session:
             async with session.begin():
                 yield session
 
+    def _current_transaction(self) -> Optional[SharedTransaction]:
+        """
+        The transaction shared by ``transaction()`` with this data layer and task, if any.
+        """
+        transaction = current_transaction.get()
+        if transaction and transaction.layer is self and transaction.task is asyncio.current_task():
+            return transaction
+        return None
+
+    def _after_commit(self, callback):
+        """
+        Run a callback, such as a cache update, once the data it reflects is committed:
+        straight away, or when the enclosing ``transaction()`` block commits. It never runs
+        if that block rolls back.
+
+        :param callback: A function taking no arguments.
+        """
+        transaction = self._current_transaction()
+        if transaction:
+            transaction.after_commit.append(callback)
+        else:
+            callback()
+
+    def _evict_thread_author(self, thread_id: str):
+        """
+        Drop a thread's cached author after its author changed or the thread was deleted.
+
+        :param thread_id: The ID of the thread.
+        """
+        self.thread_author_cache.pop(thread_id)
+        if self._current_transaction():
+            # Until the shared transaction commits, other tasks still read (and may cache)
+            # the old author, so evict it once more after the commit
+            self._after_commit(functools.partial(self.thread_author_cache.pop, thread_id))
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Share one session and transaction between all data layer calls made by the
+        current task inside the block, committing once when it exits.
+        Calls made from other tasks (Chainlit schedules many of them with
+        ``asyncio.create_task``) keep using their own sessions, since a session
+        must not be used concurrently.
+        """
+        transaction = self._current_transaction()
+        if transaction:
+            # Nested blocks join the outer one and commit with it
+            yield transaction.session
+            return
+
+        async with self.async_context() as session:
+            transaction = SharedTransaction(self, asyncio.current_task(), session, [])
+            token = current_transaction.set(transaction)
+            try:
+                yield session
+            finally:
+                current_transaction.reset(token)
+
+        for callback in transaction.after_commit:
+            callback()
+
+    def _insert(self, model):
+        """
+        Build a dialect specific INSERT statement that supports ``ON CONFLICT`` clauses.
+
+        :param model: The model to insert into.
+        :return: An insert statement for the configured database.
+        """
+        if self.engine.dialect.name == 'postgresql':
+            return pg_insert(model)
+        return sqlite_insert(model)
+
+    def _is_valid_id(self, value: str) -> bool:
+        """
+        Check whether an ID coming from outside (e.g. a thread ID taken from a URL) can be
+        looked up at all. PostgreSQL stores IDs as native uuids and rejects anything else
+        with an error, whereas no such row can exist anyway.
+
+        :param value: The ID to check.
+        :return: False if the database would reject the ID, True otherwise.
+        """
+        if self.engine.dialect.name != 'postgresql':
+            return True
+        try:
+            uuid.UUID(str(value))
+        except ValueError:
+            return False
+        return True
+
     async def get_user(self, identifier: str, no_create=False) -> Optional["PersistedUser"]:
         """
         Retrieve a user by their identifier.
@@ -57,27 +324,31 @@ class SqlDataLayer(BaseDataLayer):
         :param identifier: The unique identifier of the user.
         :return: An instance of PersistedUser if found, otherwise None.
         """
+        persisted_user = self.user_cache.get(identifier)
+        if persisted_user:
+            return persisted_user
+
         async with self.async_context() as session:
             result = await session.execute(
-                select(PersistedUserModel).where(PersistedUserModel.identifier == identifier)
+                select(*USER_COLUMNS).where(PersistedUserModel.identifier == identifier)
             )
 
-            user_model = result.scalars().first()
+            user_model = result.one_or_none()
 
-            if user_model:
-                return PersistedUser(
-                    id=user_model.id,
-                    identifier=user_model.identifier,
-                    createdAt=str(user_model.createdAt),
-                    metadata=user_model.metadata_ or {}
-                )
+        if user_model:
+            persisted_user = PersistedUser(
+                id=user_model.id,
+                identifier=user_model.identifier,
+                createdAt=date_serialize(user_model.createdAt),
+                metadata=user_model.metadata_ or {}
+            )
+            self._after_commit(functools.partial(self.user_cache.set, identifier, persisted_user))
+            return persisted_user
 
         if not no_create:
-            await self.create_user(
+            return await self.create_user(
                 user=User(identifier=identifier)
             )
-
-            return self.get_user(identifier, no_create=True)
         else:
             return None
 
@@ -89,28 +360,27 @@ class SqlDataLayer(BaseDataLayer):
         :return: An instance of PersistedUser with the created or updated user's details.
         """
         async with self.async_context() as session:
-            result = await session.execute(
-                select(PersistedUserModel).where(PersistedUserModel.identifier == user.identifier)
-            )
-            user_model = result.scalars().first()
-            if user_model:
-                user_model.metadata_ = user.metadata
-            else:
-                user_model = PersistedUserModel(
-                    id=str(uuid.uuid4()),
-                    identifier=user.identifier,
-                    createdAt=datetime.now(timezone.utc),
-                    metadata=user.metadata
-                )
-                session.add(user_model)
-            await session.commit()
-
-            return PersistedUser(
-                id=user_model.id,
-                identifier=user_model.identifier,
-                createdAt=str(user_model.createdAt),
-                metadata=user_model.metadata_
+            stmt = self._insert(PersistedUserModel).values(
+                id=str(uuid.uuid4()),
+                identifier=user.identifier,
+                createdAt=datetime.now(timezone.utc),
+                metadata_=user.metadata
             )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[PersistedUserModel.identifier],
+                set_={'metadata_': stmt.excluded.metadata_}
+            ).returning(*USER_COLUMNS)
+            result = await session.execute(stmt)
+            user_model = result.one()
+
+        persisted_user = PersistedUser(
+            id=user_model.id,
+            identifier=user_model.identifier,
+            createdAt=date_serialize(user_model.createdAt),
+            metadata=user_model.metadata_
+        )
+        self._after_commit(functools.partial(self.user_cache.set, persisted_user.identifier, persisted_user))
+        return persisted_user
 
     async def delete_user_session(self, id: str) -> bool:
         """
@@ -128,30 +398,27 @@ class SqlDataLayer(BaseDataLayer):
         :param feedback: An instance of Feedback containing the feedback details.
         :return: The ID of the inserted or updated feedback.
         """
-        if feedback.id:
-            async with self.async_context() as session:
+        async with self.async_context() as session:
+            if feedback.id:
+                # Feedback that has since been deleted must not be brought back, so an
+                # existing ID is only ever updated
                 await session.execute(
-                    update(FeedbackModel).
-                    where(FeedbackModel.id == feedback.id).
-                    values(
-                        comment=feedback.comment,
-                        value=str(feedback.value)
-                    )
+                    update(FeedbackModel)
+                    .where(FeedbackModel.id == int(feedback.id))
+                    .values(value=str(feedback.value), comment=feedback.comment)
                 )
-                await session.commit()
-            return feedback.id
-        else:
-            async with self.async_context() as session:
-                new_feedback = FeedbackModel(
+                return str(feedback.id)
+
+            result = await session.execute(
+                insert(FeedbackModel).values(
                     for_id=feedback.forId,
                     value=str(feedback.value),
                     comment=feedback.comment,
-                )
-                session.add(new_feedback)
-                await session.commit()
-                return str(new_feedback.id)
+                ).returning(FeedbackModel.id)
+            )
+            return str(result.scalar_one())
 
-    @queue_until_user_message()
+    @batch_until_user_message()
     async def create_element(self, element_dict: "ElementDict") -> "ElementDict":
         """
         Create a new element and persist it to the database.
@@ -160,39 +427,11 @@ class SqlDataLayer(BaseDataLayer):
         :return: A dictionary with the created element's details.
         """
         async with self.async_context() as session:
-            new_element = ElementModel(
-                id=element_dict["id"],
-                thread_id=element_dict["threadId"],
-                type=element_dict["type"],
-                chainlit_key=element_dict.get("chainlitKey"),
-                url=element_dict.get("url"),
-                object_key=element_dict.get("objectKey"),
-                name=element_dict["name"],
-                display=element_dict["display"],
-                size=element_dict.get("size"),
-                language=element_dict.get("language"),
-                mime=element_dict.get("mime"),
-                for_id=element_dict.get("forId"),
-                page=element_dict.get("page"),
+            result = await session.execute(
+                insert(ElementModel).values(**element_values(element_dict)).returning(*ELEMENT_COLUMNS)
             )
-            session.add(new_element)
-            await session.commit()
-
-            return {
-                "id": new_element.id,
-                "threadId": new_element.thread_id,
-                "type": new_element.type,
-                "chainlitKey": new_element.chainlit_key,
-                "url": new_element.url,
-                "objectKey": new_element.object_key,
-                "name": new_element.name,
-                "display": new_element.display,
-                "size": new_element.size,
-                "language": new_element.language,
-                "mime": new_element.mime,
-                "forId": new_element.for_id,
-                "page": new_element.page,
-            }
+
+            return element_serialize(result.one())
 
     async def get_element(self, thread_id: str, element_id: str) -> Optional["ElementDict"]:
         """
@@ -202,33 +441,22 @@ class SqlDataLayer(BaseDataLayer):
         :param element_id: The ID of the element to retrieve.
         :return: A dictionary with the element's details if found, otherwise None.
         """
+        if not (self._is_valid_id(thread_id) and self._is_valid_id(element_id)):
+            return None
+
         async with self.async_context() as session:
             result = await session.execute(
-                select(ElementModel).where(
+                select(*ELEMENT_COLUMNS).where(
                     ElementModel.thread_id == thread_id,
                     ElementModel.id == element_id
                 )
             )
-            element = result.scalars().first()
+            element = result.one_or_none()
             if element:
-                return {
-                    "id": element.id,
-                    "threadId": element.thread_id,
-                    "type": element.type,
-                    "chainlitKey": element.chainlit_key,
-                    "url": element.url,
-                    "objectKey": element.object_key,
-                    "name": element.name,
-                    "display": element.display,
-                    "size": element.size,
-                    "language": element.language,
-                    "mime": element.mime,
-                    "forId": element.for_id,
-                    "page": element.page,
-                }
+                return element_serialize(element)
             return None
 
-    @queue_until_user_message()
+    @batch_until_user_message()
     async def delete_element(self, element_id: str) -> bool:
         """
         Delete an element by its ID.
@@ -238,16 +466,11 @@ class SqlDataLayer(BaseDataLayer):
         """
         async with self.async_context() as session:
             result = await session.execute(
-                select(ElementModel).where(ElementModel.id == element_id)
+                delete(ElementModel).where(ElementModel.id == element_id)
             )
-            element = result.scalars().first()
-            if element:
-                await session.delete(element)
-                await session.commit()
-                return True
-            return False
+            return result.rowcount > 0
 
-    @queue_until_user_message()
+    @batch_until_user_message()
     async def create_step(self, step_dict: "StepDict") -> "StepDict":
         """
         Create a new step and persist it to the database.
@@ -256,36 +479,13 @@ class SqlDataLayer(BaseDataLayer):
         :return: A dictionary with the created step's details.
         """
         async with self.async_context() as session:
-            new_step = StepModel(
-                id=step_dict["id"],
-                thread_id=step_dict["threadId"],
-                parent_id=step_dict.get("parentId"),
-                name=step_dict["name"],
-                type=step_dict["type"],
-                input=step_dict.get("input"),
-                output=step_dict.get("output"),
-                metadata_=step_dict.get("metadata"),
-                created_at=datetime.now(timezone.utc),
-                start_time=datetime.now(timezone.utc),
-                end_time=None,
+            result = await session.execute(
+                insert(StepModel).values(**step_values(step_dict)).returning(*STEP_COLUMNS)
             )
-            session.add(new_step)
-            await session.commit()
-
-            return {
-                "id": new_step.id,
-                "threadId": new_step.thread_id,
-                "name": new_step.name,
-                "type": new_step.type,
-                "input": new_step.input,
-                "output": new_step.output,
-                "metadata": new_step.metadata_,
-                "createdAt": date_serialize(new_step.created_at),
-                "start": date_serialize(new_step.start_time),
-                "end": date_serialize(new_step.end_time),
-            }
 
-    @queue_until_user_message()
+            return step_serialize(result.one())
+
+    @batch_until_user_message()
     async def update_step(self, step_dict: "StepDict") -> "StepDict":
         """
         Update an existing step's details in the database.
@@ -295,40 +495,17 @@ class SqlDataLayer(BaseDataLayer):
         """
         async with self.async_context() as session:
             result = await session.execute(
-                select(StepModel).where(StepModel.id == step_dict["id"])
+                update(StepModel).where(StepModel.id == step_dict["id"]).values(
+                    **step_update_values(step_dict)
+                ).returning(*STEP_COLUMNS)
             )
-            step = result.scalars().first()
-            if step:
-                step.name = step_dict["name"]
-                step.type = step_dict["type"]
-                step.input = step_dict.get("input")
-                step.output = step_dict.get("output")
-                step.metadata_ = step_dict.get("metadata")
-                step.created_at = datetime.fromisoformat(
-                    step_dict.get("createdAt").replace("Z", "+00:00")) if step_dict.get(
-                    "createdAt") else step.created_at
-                step.start_time = datetime.fromisoformat(
-                    step_dict.get("start").replace("Z", "+00:00")) if step_dict.get("start") else step.start_time
-                step.end_time = datetime.fromisoformat(step_dict.get("end").replace("Z", "+00:00")) if step_dict.get(
-                    "end") else step.end_time
-                await session.commit()
-
-                return {
-                    "id": step.id,
-                    "threadId": step.thread_id,
-                    "name": step.name,
-                    "type": step.type,
-                    "input": step.input,
-                    "output": step.output,
-                    "metadata": step.metadata_,
-                    "createdAt": date_serialize(step.created_at),
-                    "start": date_serialize(step.start_time),
-                    "end": date_serialize(step.end_time),
-                }
-            else:
+            step = result.one_or_none()
+            if step is None:
                 raise ValueError(f"Step with ID {step_dict['id']} not found")
 
-    @queue_until_user_message()
+            return step_serialize(step)
+
+    @batch_until_user_message()
     async def delete_step(self, step_id: str) -> bool:
         """
         Delete a step by its ID.
@@ -337,15 +514,64 @@ class SqlDataLayer(BaseDataLayer):
         :return: True if the step was successfully deleted, False otherwise.
         """
         async with self.async_context() as session:
+            await session.execute(
+                delete(FeedbackModel).where(FeedbackModel.for_id == step_id)
+            )
             result = await session.execute(
-                select(StepModel).where(StepModel.id == step_id)
+                delete(StepModel).where(StepModel.id == step_id)
             )
-            step = result.scalars().first()
-            if step:
-                await session.delete(step)
-                await session.commit()
-                return True
-            return False
+            return result.rowcount > 0
+
+    async def flush_queued_writes(self, operations: List[tuple]):
+        """
+        Write the calls queued by ``batch_until_user_message`` in a single transaction.
+        Consecutive calls to the same method are grouped into one statement, run in its
+        own savepoint. If a group fails, its calls are retried one at a time and only the
+        failing ones are dropped (and logged), just like Chainlit's own queue flush.
+
+        :param operations: The queued ``(method name, argument)`` pairs, in call order.
+        """
+        async with self.async_context() as session:
+            for method_name, group in itertools.groupby(operations, key=lambda operation: operation[0]):
+                arguments = [argument for _, argument in group]
+                try:
+                    async with session.begin_nested():
+                        await self._write_queued(session, method_name, arguments)
+                    continue
+                except Exception:
+                    if len(arguments) == 1:
+                        logger.exception(f"Error while flushing {method_name}")
+                        continue
+
+                for argument in arguments:
+                    try:
+                        async with session.begin_nested():
+                            await self._write_queued(session, method_name, [argument])
+                    except Exception:
+                        logger.exception(f"Error while flushing {method_name}")
+
+    async def _write_queued(self, session: AsyncSession, method_name: str, arguments: List):
+        """
+        Apply a run of queued calls to the same method with one statement per table.
+
+        :param session: The session of the flush.
+        :param method_name: The name of the queued method.
+        :param arguments: The queued arguments, in call order.
+        """
+        if method_name == 'create_element':
+            await session.execute(insert(ElementModel), [element_values(d) for d in arguments])
+        elif method_name == 'create_step':
+            await session.execute(insert(StepModel), [step_values(d) for d in arguments])
+        elif method_name == 'update_step':
+            await session.execute(
+                update(StepModel),
+                [dict(id=d["id"], **step_update_values(d)) for d in arguments]
+            )
+        elif method_name == 'delete_element':
+            await session.execute(delete(ElementModel).where(ElementModel.id.in_(arguments)))
+        elif method_name == 'delete_step':
+            await session.execute(delete(FeedbackModel).where(FeedbackModel.for_id.in_(arguments)))
+            await session.execute(delete(StepModel).where(StepModel.id.in_(arguments)))
 
     async def get_thread(self, thread_id: str) -> "Optional[ThreadDict]":
         """
@@ -354,72 +580,24 @@ class SqlDataLayer(BaseDataLayer):
         :param thread_id: The ID of the thread to retrieve.
         :return: A dictionary with the thread's details if found, otherwise None.
         """
+        if not self._is_valid_id(thread_id):
+            return None
+
         async with self.async_context() as session:
             result = await session.execute(
-                select(ThreadModel).where(ThreadModel.id == thread_id)
+                select(*THREAD_COLUMNS).outerjoin(ThreadModel.user).where(ThreadModel.id == thread_id)
             )
-            thread_model = result.scalars().first()
-            if thread_model:
-                # Retrieve steps for the thread
+            thread = result.one_or_none()
+            if thread:
                 steps_result = await session.execute(
-                    select(StepModel).where(StepModel.thread_id == thread_id)
+                    select(*STEP_COLUMNS)
+                    .where(StepModel.thread_id == thread_id)
+                    .order_by(StepModel.created_at)
                 )
-                steps = steps_result.scalars().all()
-
-                # Retrieve elements for the thread
                 elements_result = await session.execute(
-                    select(ElementModel).where(ElementModel.thread_id == thread_id)
+                    select(*ELEMENT_COLUMNS).where(ElementModel.thread_id == thread_id)
                 )
-                elements = elements_result.scalars().all()
-
-                # Retrieve user for the thread
-                user_result = await session.execute(
-                    select(PersistedUserModel).where(PersistedUserModel.id == thread_model.user_id)
-                )
-                user_model = user_result.scalars().first()
-                user_dict = {
-                    "id": user_model.id,
-                    "identifier": user_model.identifier,
-                    "createdAt": user_model.createdAt.isoformat() if thread_model.createdAt else None,
-                    "metadata": user_model.metadata_
-                } if user_model else None
-
-                return {
-                    "id": thread_model.id,
-                    "name": thread_model.name,
-                    "createdAt": date_serialize(thread_model.createdAt),
-                    "metadata": thread_model.metadata_,
-                    "tags": thread_model.tags,
-                    "user": user_dict,
-                    "steps": [{
-                        "id": step.id,
-                        "threadId": step.thread_id,
-                        "parentId": step.parent_id,
-                        "name": step.name,
-                        "type": step.type,
-                        "input": step.input,
-                        "output": step.output,
-                        "metadata": step.metadata_,
-                        "createdAt": date_serialize(step.created_at),
-                        "start": date_serialize(step.start_time),
-                        "end": date_serialize(step.end_time),
-                    } for step in steps],
-                    "elements": [{
-                        "id": element.id,
-                        "threadId": element.thread_id,
-                        "type": element.type,
-                        "chainlitKey": element.chainlit_key,
-                        "url": element.url,
-                        "objectKey": element.object_key,
-                        "name": element.name,
-                        "display": element.display,
-                        "size": element.size,
-                        "language": element.language,
-                        "mime": element.mime,
-                        "forId": element.for_id,
-                        "page": element.page,
-                    } for element in elements],
-                }
+                return thread_serialize(thread, steps_result.all(), elements_result.all())
             return None
 
     async def get_thread_author(self, thread_id: str) -> str:
@@ -429,12 +607,22 @@ class SqlDataLayer(BaseDataLayer):
         :param thread_id: The ID of the thread.
         :return: The identifier of the thread's author.
         """
+        user_identifier = self.thread_author_cache.get(thread_id)
+        if user_identifier:
+            return user_identifier
+        if not self._is_valid_id(thread_id):
+            return ""
+
         async with self.async_context() as session:
             result = await session.execute(
                 select(PersistedUserModel.identifier).join(ThreadModel).where(ThreadModel.id == thread_id)
             )
-            user_identifier = result.scalars().first()
-            return user_identifier if user_identifier else ""
+            user_identifier = result.scalar_one_or_none()
+
+        if user_identifier:
+            self._after_commit(functools.partial(self.thread_author_cache.set, thread_id, user_identifier))
+            return user_identifier
+        return ""
 
     async def delete_thread(self, thread_id: str):
         """
@@ -443,16 +631,27 @@ class SqlDataLayer(BaseDataLayer):
         :param thread_id: The ID of the thread to delete.
         :return: True if the thread was successfully deleted, False otherwise.
         """
+        if not self._is_valid_id(thread_id):
+            return False
+
         async with self.async_context() as session:
+            # Bulk deletes bypass ORM cascades, so remove the thread's children first
+            step_ids = select(StepModel.id).where(StepModel.thread_id == thread_id)
+            await session.execute(
+                delete(FeedbackModel).where(FeedbackModel.for_id.in_(step_ids))
+            )
+            await session.execute(
+                delete(ElementModel).where(ElementModel.thread_id == thread_id)
+            )
+            await session.execute(
+                delete(StepModel).where(StepModel.thread_id == thread_id)
+            )
             result = await session.execute(
-                select(ThreadModel).where(ThreadModel.id == thread_id)
+                delete(ThreadModel).where(ThreadModel.id == thread_id)
             )
-            thread = result.scalars().first()
-            if thread:
-                await session.delete(thread)
-                await session.commit()
-                return True
-            return False
+
+        self._evict_thread_author(thread_id)
+        return result.rowcount > 0
 
     async def list_threads(self, pagination: "Pagination", filters: "ThreadFilter") -> "PaginatedResponse[ThreadDict]":
         """
@@ -463,82 +662,54 @@ class SqlDataLayer(BaseDataLayer):
         :return: A PaginatedResponse containing a list of threads and page information.
         """
         async with self.async_context() as session:
-            query = select(ThreadModel).options(selectinload(ThreadModel.user)).join(PersistedUserModel)
+            query = select(*THREAD_COLUMNS).join(ThreadModel.user)
             if filters.userId:
-                query = query.where(PersistedUserModel.id == filters.userId)
+                query = query.where(ThreadModel.user_id == filters.userId)
             if filters.search:
                 query = query.where(ThreadModel.name.ilike(f'%{filters.search}%'))
             if filters.feedback is not None:
                 raise NotImplementedError("This feature is not implemented yet.")
 
-            query = query.order_by(ThreadModel.createdAt.desc())
-            if pagination.cursor:
-                query = query.where(ThreadModel.id > pagination.cursor)
-            query = query.limit(pagination.first)
+            query = query.order_by(ThreadModel.createdAt.desc(), ThreadModel.id.desc())
+            # A malformed or stale cursor starts over from the first page
+            cursor = cursor_deserialize(pagination.cursor) if pagination.cursor else None
+            if cursor and self._is_valid_id(cursor[1]):
+                query = query.where(tuple_(ThreadModel.createdAt, ThreadModel.id) < cursor)
+            # Fetch one extra row to find out whether there is a next page
+            query = query.limit(pagination.first + 1)
 
             result = await session.execute(query)
-            threads = result.scalars().all()
-
-            # Convert ThreadModel instances to ThreadDict
-            threads_data = []
-            for thread in threads:
-                # Explicitly load steps for the thread
+            threads = result.all()
+            has_next_page = len(threads) > pagination.first
+            threads = threads[:pagination.first]
+
+            # Load the steps and elements of the whole page at once, then group them per thread
+            thread_ids = [thread.id for thread in threads]
+            steps = defaultdict(list)
+            elements = defaultdict(list)
+            if thread_ids:
                 steps_result = await session.execute(
-                    select(StepModel).where(StepModel.thread_id == thread.id)
+                    select(*STEP_COLUMNS)
+                    .where(StepModel.thread_id.in_(thread_ids))
+                    .order_by(StepModel.thread_id, StepModel.created_at)
                 )
-                steps = steps_result.scalars().all()
+                for step in steps_result:
+                    steps[step.thread_id].append(step)
 
-                # Explicitly load elements for the thread
                 elements_result = await session.execute(
-                    select(ElementModel).where(ElementModel.thread_id == thread.id)
+                    select(*ELEMENT_COLUMNS).where(ElementModel.thread_id.in_(thread_ids))
                 )
-                elements = elements_result.scalars().all()
-
-                threads_data.append({
-                    "id": thread.id,
-                    "name": thread.name,
-                    "createdAt": date_serialize(thread.createdAt),
-                    "metadata": thread.metadata_,
-                    "tags": thread.tags,
-                    "user": {
-                        "id": thread.user.id,
-                        "identifier": thread.user.identifier,
-                        "createdAt": date_serialize(thread.user.createdAt),
-                        "metadata": thread.user.metadata_
-                    },
-                    "steps": [{
-                        "id": step.id,
-                        "threadId": step.thread_id,
-                        "name": step.name,
-                        "type": step.type,
-                        "input": step.input,
-                        "output": step.output,
-                        "metadata": step.metadata_,
-                        "createdAt": date_serialize(step.created_at),
-                        "start": date_serialize(step.start_time),
-                        "end": date_serialize(step.end_time),
-                    } for step in steps],
-                    "elements": [{
-                        "id": element.id,
-                        "threadId": element.thread_id,
-                        "type": element.type,
-                        "chainlitKey": element.chainlit_key,
-                        "url": element.url,
-                        "objectKey": element.object_key,
-                        "name": element.name,
-                        "display": element.display,
-                        "size": element.size,
-                        "language": element.language,
-                        "mime": element.mime,
-                        "forId": element.for_id,
-                        "page": element.page,
-                    } for element in elements],
-                })
+                for element in elements_result:
+                    elements[element.thread_id].append(element)
+
+            threads_data = [
+                thread_serialize(thread, steps[thread.id], elements[thread.id]) for thread in threads
+            ]
 
             page_info = PageInfo(
-                hasNextPage=len(threads) == pagination.first,
-                startCursor=threads[0].id if threads else None,
-                endCursor=threads[-1].id if threads else None
+                hasNextPage=has_next_page,
+                startCursor=cursor_serialize(threads[0]) if threads else None,
+                endCursor=cursor_serialize(threads[-1]) if threads else None
             ).to_dict()
 
             response = PaginatedResponse(data=threads_data, pageInfo=page_info)
@@ -556,10 +727,11 @@ class SqlDataLayer(BaseDataLayer):
         :param tags: The new list of tags for the thread, if provided.
         """
         async with self.async_context() as session:
+            # Only the thread's own columns are touched here, so skip its eagerly loaded collections
             result = await session.execute(
-                select(ThreadModel).where(ThreadModel.id == thread_id)
+                select(ThreadModel).where(ThreadModel.id == thread_id).options(raiseload('*'))
             )
-            thread = result.scalars().first()
+            thread = result.scalar_one_or_none()
             if not thread:
                 thread = ThreadModel(
                     id=thread_id,
@@ -577,7 +749,28 @@ class SqlDataLayer(BaseDataLayer):
                 thread.tags = tags
 
             session.add(thread)
-            await session.commit()
+
+        if user_id is not None:
+            self._evict_thread_author(thread_id)
+
+
+def create_unique_indexes(connection):
+    """
+    Add the unique indexes the upserts rely on to tables created by older releases, which
+    ``create_all`` leaves untouched.
+
+    :param connection: A synchronous connection inside a transaction.
+    """
+    for index in PersistedUserModel.__table__.indexes:
+        if not index.unique:
+            continue
+        try:
+            index.create(connection, checkfirst=True)
+        except IntegrityError as error:
+            raise RuntimeError(
+                f"Cannot create the unique index {index.name}: the users table contains duplicate "
+                f"identifiers. Merge them as described under \"Upgrading from 0.1.x\" in the README."
+            ) from error
 
 
 def date_serialize(date: datetime) -> str:
@@ -585,3 +778,142 @@ def date_serialize(date: datetime) -> str:
         return None
 
     return date.isoformat()
+
+
+def date_deserialize(date: Optional[str]) -> Optional[datetime]:
+    if not date:
+        return None
+
+    # datetime.fromisoformat() only accepts the "Z" suffix from Python 3.11 onwards
+    if date.endswith("Z"):
+        date = date[:-1] + "+00:00"
+    return datetime.fromisoformat(date)
+
+
+def element_values(element_dict: "ElementDict") -> Dict:
+    if not isinstance(element_dict, dict):
+        # Chainlit's Element.send hands over the Element itself rather than its dict
+        element_dict = element_dict.to_dict()
+    return dict(
+        id=element_dict["id"],
+        thread_id=element_dict["threadId"],
+        type=element_dict["type"],
+        chainlit_key=element_dict.get("chainlitKey"),
+        url=element_dict.get("url"),
+        object_key=element_dict.get("objectKey"),
+        name=element_dict["name"],
+        display=element_dict["display"],
+        size=element_dict.get("size"),
+        language=element_dict.get("language"),
+        mime=element_dict.get("mime"),
+        for_id=element_dict.get("forId"),
+        page=element_dict.get("page"),
+    )
+
+
+def step_values(step_dict: "StepDict") -> Dict:
+    now = datetime.now(timezone.utc)
+    return dict(
+        id=step_dict["id"],
+        thread_id=step_dict["threadId"],
+        parent_id=step_dict.get("parentId"),
+        name=step_dict["name"],
+        type=step_dict["type"],
+        input=step_dict.get("input"),
+        output=step_dict.get("output"),
+        metadata_=step_dict.get("metadata"),
+        created_at=now,
+        start_time=now,
+        end_time=None,
+    )
+
+
+def step_update_values(step_dict: "StepDict") -> Dict:
+    values = dict(
+        name=step_dict["name"],
+        type=step_dict["type"],
+        input=step_dict.get("input"),
+        output=step_dict.get("output"),
+        metadata_=step_dict.get("metadata"),
+    )
+    for key, column in (("createdAt", "created_at"), ("start", "start_time"), ("end", "end_time")):
+        date = date_deserialize(step_dict.get(key))
+        if date:
+            values[column] = date
+    return values
+
+
+def json_serialize(value) -> str:
+    # Non-string keys are stringified, matching the standard library's json.dumps()
+    try:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+    except TypeError:
+        # orjson rejects what json.dumps() accepts, such as integers beyond 64 bits
+        return json.dumps(value)
+
+
+def cursor_serialize(thread) -> str:
+    cursor = f"{thread.createdAt.isoformat()}|{thread.id}"
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def cursor_deserialize(cursor: str) -> Optional[tuple]:
+    try:
+        created_at, thread_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(created_at), thread_id
+    except ValueError:
+        # Covers bad base64 (binascii.Error), bad UTF-8 and a missing separator or date
+        logger.warning(f"Ignoring malformed thread list cursor {cursor!r}")
+        return None
+
+
+def thread_serialize(thread, steps, elements) -> "ThreadDict":
+    return {
+        "id": thread.id,
+        "name": thread.name,
+        "createdAt": date_serialize(thread.createdAt),
+        "metadata": thread.metadata_,
+        "tags": thread.tags,
+        "user": {
+            "id": thread.user_id,
+            "identifier": thread.user_identifier,
+            "createdAt": date_serialize(thread.user_createdAt),
+            "metadata": thread.user_metadata
+        } if thread.user_id else None,
+        "steps": [step_serialize(step) for step in steps],
+        "elements": [element_serialize(element) for element in elements],
+    }
+
+
+def step_serialize(step) -> "StepDict":
+    return {
+        "id": step.id,
+        "threadId": step.thread_id,
+        "parentId": step.parent_id,
+        "name": step.name,
+        "type": step.type,
+        "input": step.input,
+        "output": step.output,
+        "metadata": step.metadata_,
+        "createdAt": date_serialize(step.created_at),
+        "start": date_serialize(step.start_time),
+        "end": date_serialize(step.end_time),
+    }
+
+
+def element_serialize(element) -> "ElementDict":
+    return {
+        "id": element.id,
+        "threadId": element.thread_id,
+        "type": element.type,
+        "chainlitKey": element.chainlit_key,
+        "url": element.url,
+        "objectKey": element.object_key,
+        "name": element.name,
+        "display": element.display,
+        "size": element.size,
+        "language": element.language,
+        "mime": element.mime,
+        "forId": element.for_id,
+        "page": element.page,
+    }
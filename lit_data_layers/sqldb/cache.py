@@ -0,0 +1,52 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    A small in-process cache whose entries expire after a fixed time-to-live.
+    Once full, the oldest entries are evicted first.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Retrieve a cached value.
+
+        :param key: The key of the entry.
+        :param default: The value to return if the entry is missing or expired.
+        :return: The cached value, or the default.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return default
+        return value
+
+    def set(self, key, value):
+        """
+        Store a value, replacing any existing entry for the key.
+
+        :param key: The key of the entry.
+        :param value: The value to cache.
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        """
+        Remove an entry if it exists.
+
+        :param key: The key of the entry.
+        """
+        self._entries.pop(key, None)
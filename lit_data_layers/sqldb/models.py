@@ -1,112 +1,239 @@
-import datetime
+from datetime import datetime
+from typing import List, Optional
 
-from sqlalchemy import Column, String, Boolean, Integer, func
-from sqlalchemy import DateTime, Text
+from sqlalchemy import CheckConstraint, String, Enum, Integer, SmallInteger, Index, Uuid, func
+from sqlalchemy import DateTime, Text, inspect, text
 from sqlalchemy import ForeignKey
 from sqlalchemy import JSON
-from sqlalchemy.dialects.postgresql import ENUM
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
-Base = declarative_base()
+
+class Base(DeclarativeBase):
+    """
+    Behaviour shared by every model.
+    """
+
+    def __repr__(self):
+        # Only the identity key is shown: it never triggers a load, even on expired or
+        # detached instances whose other attributes would need a SELECT
+        identity = inspect(self).identity
+        key = identity[0] if identity and len(identity) == 1 else identity
+        return f"<{type(self).__name__}(id={key!r})>"
+
+
+# Chainlit identifies users, threads, steps and elements by UUID strings. PostgreSQL stores them
+# as a native 16 byte uuid (still read and written as str); elsewhere they stay hyphenated
+# strings, so databases created before the uuid type keep matching their existing ids
+UUIDString = String(36).with_variant(Uuid(as_uuid=False), 'postgresql')
+
+# Binary, indexable JSONB on PostgreSQL and plain JSON everywhere else
+JSONVariant = JSON().with_variant(JSONB(), 'postgresql')
+
+
+def jsonb_path_index(name: str, column: str) -> Index:
+    """
+    A PostgreSQL-only GIN index serving JSONB containment (``@>``) and path (``@?``) lookups.
+    """
+    return Index(
+        name, column, postgresql_using='gin', postgresql_ops={column: 'jsonb_path_ops'}
+    ).ddl_if(dialect='postgresql')
 
 
 class ElementModel(Base):
+    """
+    A file, image or other attachment shown in a thread. The ``thread`` relationship raises when
+    lazily loaded; select ``thread_id`` or join explicitly instead.
+    """
     __tablename__ = 'elements'
-
-    id = Column(String, primary_key=True)
-    type = Column(String, nullable=False)
-    name = Column(String, nullable=False)
-    chainlit_key = Column(String)
-    url = Column(String)
-    object_key = Column(String)
-    path = Column(String)
-    display = Column(String, nullable=False)
-    size = Column(String)
-    for_id = Column(String)
-    language = Column(String)
-    mime = Column(String)
-    content = Column(String)
-    page = Column(Integer)
-    thread_id = Column(String, ForeignKey('threads.id'), nullable=False)
-    persisted = Column(Boolean, default=False)
-    updatable = Column(Boolean, default=False)
+    __table_args__ = (
+        # Serves both thread lookups and get_element's (thread_id, id) filter
+        Index('ix_elements_thread_id_id', 'thread_id', 'id'),
+    )
+
+    id: Mapped[str] = mapped_column(UUIDString, primary_key=True)
+    # Kept as a string like steps.type: newer Chainlit releases add element types, which a
+    # native enum would reject
+    type: Mapped[str] = mapped_column(String, nullable=False)
+    name: Mapped[str] = mapped_column(String, nullable=False)
+    chainlit_key: Mapped[Optional[str]] = mapped_column(String)
+    url: Mapped[Optional[str]] = mapped_column(Text)
+    object_key: Mapped[Optional[str]] = mapped_column(Text)
+    # path, content and flags are never read by the data layer, so they are
+    # deferred to keep them out of element loads (content can be arbitrarily large)
+    path: Mapped[Optional[str]] = mapped_column(Text, deferred=True)
+    display: Mapped[str] = mapped_column(
+        Enum('inline', 'side', 'page', name='element_display'), nullable=False
+    )
+    size: Mapped[Optional[str]] = mapped_column(Enum('small', 'medium', 'large', name='element_size'))
+    for_id: Mapped[Optional[str]] = mapped_column(UUIDString)
+    language: Mapped[Optional[str]] = mapped_column(String)
+    mime: Mapped[Optional[str]] = mapped_column(String)
+    content: Mapped[Optional[str]] = mapped_column(Text, deferred=True)
+    page: Mapped[Optional[int]] = mapped_column(Integer)
+    thread_id: Mapped[str] = mapped_column(UUIDString, ForeignKey('threads.id'), nullable=False)
+    # Bit-packed element flags, exposed as the persisted and updatable booleans below
+    flags: Mapped[int] = mapped_column(SmallInteger, nullable=False, server_default='0', deferred=True)
 
     # Relationships
-    thread = relationship("ThreadModel", back_populates="elements")
+    thread: Mapped["ThreadModel"] = relationship(back_populates="elements", lazy="raise")
 
-    def __repr__(self):
-        return f"<ElementModel(id='{self.id}'>"
+    PERSISTED = 1
+    UPDATABLE = 2
+
+    def _get_flag(self, flag: int) -> bool:
+        return bool((self.flags or 0) & flag)
+
+    def _set_flag(self, flag: int, value: bool):
+        self.flags = (self.flags or 0) | flag if value else (self.flags or 0) & ~flag
+
+    @hybrid_property
+    def persisted(self) -> bool:
+        return self._get_flag(self.PERSISTED)
+
+    @persisted.inplace.setter
+    def _persisted_setter(self, value: bool):
+        self._set_flag(self.PERSISTED, value)
+
+    @persisted.inplace.expression
+    @classmethod
+    def _persisted_expression(cls):
+        return cls.flags.op('&')(cls.PERSISTED) != 0
+
+    @hybrid_property
+    def updatable(self) -> bool:
+        return self._get_flag(self.UPDATABLE)
+
+    @updatable.inplace.setter
+    def _updatable_setter(self, value: bool):
+        self._set_flag(self.UPDATABLE, value)
+
+    @updatable.inplace.expression
+    @classmethod
+    def _updatable_expression(cls):
+        return cls.flags.op('&')(cls.UPDATABLE) != 0
 
 
 class PersistedUserModel(Base):
+    """
+    A user identified by its Chainlit identifier. ``threads`` raises when lazily loaded; query
+    threads by ``user_id`` instead.
+    """
     __tablename__ = 'users'
+    __table_args__ = (
+        jsonb_path_index('ix_users_metadata_gin', 'metadata_'),
+    )
 
-    id = Column(String, primary_key=True)
-    identifier = Column(String, nullable=False)
-    createdAt = Column(DateTime(timezone=True), nullable=False)
-    metadata_ = Column(JSON)  # Using JSON field for metadata
+    id: Mapped[str] = mapped_column(UUIDString, primary_key=True)
+    identifier: Mapped[str] = mapped_column(String, nullable=False, unique=True, index=True)
+    createdAt: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    metadata_: Mapped[Optional[dict]] = mapped_column(JSONVariant)  # Using JSON field for metadata
 
-    def __repr__(self):
-        return f"<PersistedUser(id='{self.id}', identifier='{self.identifier}')>"
+    # Relationships
+    threads: Mapped[List["ThreadModel"]] = relationship(back_populates="user", lazy="raise")
 
 
 class Feedback(Base):
+    """
+    Feedback left on a step. The ``step`` relationship raises when lazily loaded.
+    """
     __tablename__ = 'feedback'
-
-    id = Column(Integer, primary_key=True)
-    for_id = Column(String, ForeignKey('steps.id'), nullable=False)
-    value = Column(String)
-    strategy = Column(String, default='BINARY')
-    comment = Column(String, nullable=True)
-
-    def __repr__(self):
-        return f"<Feedback(id={self.id}, for_id='{self.for_id}')>"
+    __table_args__ = (
+        # Chainlit sends binary feedback as -1, 0 or 1
+        CheckConstraint("value IN ('-1', '0', '1')", name='ck_feedback_value'),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    for_id: Mapped[str] = mapped_column(UUIDString, ForeignKey('steps.id'), nullable=False, index=True)
+    value: Mapped[str] = mapped_column(String, nullable=False)
+    strategy: Mapped[str] = mapped_column(
+        Enum('BINARY', name='feedback_strategy'), nullable=False, server_default='BINARY'
+    )
+    comment: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
 
     # Relationship to StepModel
-    step = relationship("StepModel", back_populates="feedback")
+    step: Mapped["StepModel"] = relationship(back_populates="feedback", lazy="raise")
 
 
 class ThreadModel(Base):
+    """
+    A conversation. Loading the entity eagerly fetches ``steps`` (with their feedback) and
+    ``elements`` through selectin queries; pass ``raiseload('*')`` when only the thread's own
+    columns are needed. ``user`` raises when lazily loaded; join it explicitly.
+    """
     __tablename__ = 'threads'
-
-    id = Column(String, primary_key=True)
-    name = Column(String, nullable=True)
-    createdAt = Column(DateTime(timezone=True), nullable=False)
-    metadata_ = Column(JSON)
-    user_id = Column(String, ForeignKey('users.id'), nullable=True)
-    tags = Column(JSON)
+    __table_args__ = (
+        # Keyset pagination in list_threads orders and seeks on (createdAt, id)
+        Index('ix_threads_createdAt_id', 'createdAt', 'id'),
+        jsonb_path_index('ix_threads_metadata_gin', 'metadata_'),
+        jsonb_path_index('ix_threads_tags_gin', 'tags'),
+    )
+
+    id: Mapped[str] = mapped_column(UUIDString, primary_key=True)
+    name: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    createdAt: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    metadata_: Mapped[Optional[dict]] = mapped_column(JSONVariant)
+    user_id: Mapped[Optional[str]] = mapped_column(UUIDString, ForeignKey('users.id'), nullable=True)
+    tags: Mapped[Optional[list]] = mapped_column(JSONVariant)
 
     # Relationships
-    user = relationship("PersistedUserModel", backref="threads")
-    elements = relationship("ElementModel", back_populates="thread", cascade="all, delete, delete-orphan")
-    steps = relationship("StepModel", back_populates="thread", cascade="all, delete, delete-orphan")
-
-    def __repr__(self):
-        return f"<ThreadModel(id='{self.id}', name='{self.name}')>"
+    user: Mapped[Optional["PersistedUserModel"]] = relationship(back_populates="threads", lazy="raise")
+    # A thread is almost always needed together with its steps and elements, so loading a thread
+    # entity fetches each collection with one extra "WHERE thread_id IN (...)" query
+    elements: Mapped[List["ElementModel"]] = relationship(
+        back_populates="thread", cascade="all, delete, delete-orphan", lazy="selectin"
+    )
+    steps: Mapped[List["StepModel"]] = relationship(
+        back_populates="thread", cascade="all, delete, delete-orphan", lazy="selectin",
+        order_by="StepModel.created_at"
+    )
 
 
-# PersistedUserModel.threads = relationship("ThreadModel", order_by=ThreadModel.id, back_populates="user")
+# Listing a user's threads filters on user_id and pages through them newest first on
+# (createdAt, id), so this index serves the filter, the keyset seek and the sort in one range scan
+Index(
+    'ix_threads_user_id_createdAt_id', ThreadModel.user_id, ThreadModel.createdAt.desc(), ThreadModel.id.desc()
+)
 
 
 class StepModel(Base):
+    """
+    A message or tool run within a thread. ``feedback`` is eagerly loaded through a selectin
+    query; ``thread`` raises when lazily loaded.
+    """
     __tablename__ = 'steps'
-
-    id = Column(String, primary_key=True)
-    thread_id = Column(String, ForeignKey('threads.id'), nullable=False)
-    parent_id = Column(String, nullable=True, default=None)
-    name = Column(String, nullable=False)
-    type = Column(String, nullable=False)
-    input = Column(Text)
-    output = Column(Text)
-    metadata_ = Column(JSON)
-    created_at = Column(DateTime(timezone=True), default=lambda : datetime.now(timezone.utc))
-    start_time = Column(DateTime(timezone=True))
-    end_time = Column(DateTime(timezone=True))
+    __table_args__ = (
+        # Steps are always loaded per thread in chronological order
+        Index('ix_steps_thread_id_created_at', 'thread_id', 'created_at'),
+        # Walking the step tree of a thread: the children of a parent, and the top-level steps
+        Index('ix_steps_thread_id_parent_id', 'thread_id', 'parent_id'),
+        Index(
+            'ix_steps_thread_id_roots', 'thread_id', 'created_at',
+            postgresql_where=text('parent_id IS NULL'), sqlite_where=text('parent_id IS NULL')
+        ),
+        jsonb_path_index('ix_steps_metadata_gin', 'metadata_'),
+        # Steps are appended in time order, so a tiny BRIN summary is enough for time-range scans
+        Index(
+            'ix_steps_created_at_brin', 'created_at',
+            postgresql_using='brin', postgresql_with={'pages_per_range': 32}
+        ).ddl_if(dialect='postgresql'),
+    )
+
+    id: Mapped[str] = mapped_column(UUIDString, primary_key=True)
+    thread_id: Mapped[str] = mapped_column(UUIDString, ForeignKey('threads.id'), nullable=False)
+    parent_id: Mapped[Optional[str]] = mapped_column(UUIDString, nullable=True)
+    name: Mapped[str] = mapped_column(String, nullable=False)
+    type: Mapped[str] = mapped_column(String, nullable=False)
+    input: Mapped[Optional[str]] = mapped_column(Text)
+    output: Mapped[Optional[str]] = mapped_column(Text)
+    metadata_: Mapped[Optional[dict]] = mapped_column(JSONVariant)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+    start_time: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
+    end_time: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
 
     # Relationships
-    thread = relationship("ThreadModel", back_populates="steps")
-    feedback = relationship("Feedback", back_populates="step")
-
-    def __repr__(self):
-        return f"<StepModel(id='{self.id}', name='{self.name}', type='{self.type}')>"
+    thread: Mapped["ThreadModel"] = relationship(back_populates="steps", lazy="raise")
+    feedback: Mapped[List["Feedback"]] = relationship(back_populates="step", lazy="selectin")
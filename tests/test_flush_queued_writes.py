@@ -0,0 +1,65 @@
+import asyncio
+import uuid
+
+import pytest
+
+from lit_data_layers.sqldb import SqlDataLayer
+
+
+@pytest.fixture
+def data_layer(tmp_path, monkeypatch):
+    monkeypatch.setenv('LIT_DATABASE_URL', f"sqlite+aiosqlite:///{tmp_path / 'chainlit.db'}")
+    return SqlDataLayer()
+
+
+def step(step_id: str, thread_id: str, name: str) -> dict:
+    return {'id': step_id, 'threadId': thread_id, 'name': name, 'type': 'tool'}
+
+
+def test_failing_call_in_group_keeps_the_other_writes(data_layer):
+    thread_id = str(uuid.uuid4())
+    step_ids = [str(uuid.uuid4()) for _ in range(3)]
+
+    async def scenario():
+        await data_layer.initialize_database()
+        try:
+            await data_layer.update_thread(thread_id, name='thread')
+            await data_layer.flush_queued_writes([
+                ('create_step', step(step_ids[0], thread_id, 'first')),
+                # Same id as the first step: fails the grouped insert, then only this call on retry
+                ('create_step', step(step_ids[0], thread_id, 'duplicate')),
+                ('create_step', step(step_ids[1], thread_id, 'second')),
+                ('update_step', step(step_ids[0], thread_id, 'renamed')),
+                ('create_step', step(step_ids[2], thread_id, 'third')),
+            ])
+            return await data_layer.get_thread(thread_id)
+        finally:
+            await data_layer.engine.dispose()
+
+    thread = asyncio.run(scenario())
+
+    assert sorted(s['name'] for s in thread['steps']) == ['renamed', 'second', 'third']
+
+
+def test_failing_single_call_keeps_the_other_groups(data_layer):
+    thread_id = str(uuid.uuid4())
+    step_id = str(uuid.uuid4())
+
+    async def scenario():
+        await data_layer.initialize_database()
+        try:
+            await data_layer.update_thread(thread_id, name='thread')
+            await data_layer.flush_queued_writes([
+                ('create_step', step(step_id, thread_id, 'first')),
+                # Missing its required display field
+                ('create_element', {'id': str(uuid.uuid4()), 'threadId': thread_id, 'type': 'image', 'name': 'bad'}),
+                ('update_step', step(step_id, thread_id, 'renamed')),
+            ])
+            return await data_layer.get_thread(thread_id)
+        finally:
+            await data_layer.engine.dispose()
+
+    thread = asyncio.run(scenario())
+
+    assert [s['name'] for s in thread['steps']] == ['renamed']
+    assert thread['elements'] == []
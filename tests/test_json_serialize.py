@@ -0,0 +1,15 @@
+import json
+
+import pytest
+
+from lit_data_layers.sqldb import json_serialize, orjson
+
+
+@pytest.mark.skipif(orjson is None, reason="orjson is not installed")
+@pytest.mark.parametrize('value', [
+    {'count': 2 ** 70},
+    {1: 'non-string key'},
+    {'tags': ['a', 'b'], 'nested': {'ok': True}},
+])
+def test_json_serialize_matches_json_dumps(value):
+    assert json.loads(json_serialize(value)) == json.loads(json.dumps(value))